@@ -1,16 +1,49 @@
 # pylint: disable=redefined-outer-name
+import filelock
+import itertools
 import json
+import os
 import pytest
 import subprocess
 import pathlib
 import random
+import shlex
+import shutil
+import tempfile
 
 
 _ROOT_DIR = pathlib.Path(__file__).absolute().parent.parent
+_SHM_DIR = pathlib.Path("/dev/shm")
+
+
+_SHM_BASETEMP_KEY = pytest.StashKey[str]()
+
+
+def pytest_configure(config):
+    # keep test trees in RAM when possible, unless the user asked for a specific basetemp
+    # (xdist workers inherit theirs from the controller, so only the controller gets here)
+    if config.option.basetemp is None and os.access(_SHM_DIR, os.W_OK):
+        basetemp = tempfile.mkdtemp(prefix="ratify-tests-", dir=_SHM_DIR)
+        config.stash[_SHM_BASETEMP_KEY] = basetemp
+        config.option.basetemp = basetemp
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # failed runs keep their trees around for post-mortem
+    basetemp = session.config.stash.get(_SHM_BASETEMP_KEY, None)
+    if basetemp is not None and exitstatus == 0:
+        shutil.rmtree(basetemp, ignore_errors=True)
+
+
+_CORPUS = random.randbytes(200_000)
+_CALL_COUNTER = itertools.count()
 
 
 def random_data():
-    return bytes(random.randrange(256) for i in range(random.randrange(1000, 100_000)))
+    size = random.randrange(1000, 100_000)
+    offset = random.randrange(len(_CORPUS) - size)
+    # stamp a call counter at the start so consecutive calls never return identical data
+    return next(_CALL_COUNTER).to_bytes(8, "little") + _CORPUS[offset + 8 : offset + size]
 
 
 @pytest.fixture
@@ -18,31 +51,105 @@ def random_data_gen():
     return random_data
 
 
+def _newest_source_mtime():
+    sources = [
+        *(_ROOT_DIR / name for name in ("Cargo.toml", "Cargo.lock")),
+        *(_ROOT_DIR / "src").rglob("*.rs"),
+    ]
+    return max(p.stat().st_mtime for p in sources if p.exists())
+
+
+def _is_stale(target: pathlib.Path):
+    return not target.exists() or target.stat().st_mtime < _newest_source_mtime()
+
+
 @pytest.fixture(scope="session")
 def binary():
-    subprocess.check_call("cargo build", shell=True, cwd=_ROOT_DIR)
-    return _ROOT_DIR / "target" / "debug" / "ratify"
+    # cargo resolves a relative CARGO_TARGET_DIR against its cwd, which is _ROOT_DIR
+    target_dir = _ROOT_DIR / os.environ.get("CARGO_TARGET_DIR", "target")
+    target = target_dir / "debug" / "ratify"
+    if not _is_stale(target):
+        return target
+    target_dir.mkdir(parents=True, exist_ok=True)
+    # under xdist every worker gets its own session -- make sure only one of them builds
+    with filelock.FileLock(target_dir / ".ratify-build.lock"):
+        if _is_stale(target):
+            subprocess.check_call(["cargo", "build"], cwd=_ROOT_DIR)
+    return target
 
 
 @pytest.fixture
 def run(binary):
-    def run_func(cmdline, **kw):
-        cmdline = f"{binary} -vvv {cmdline}"
-        print("*** Running", cmdline)
-        return subprocess.check_output(cmdline, shell=True, **kw)
+    def run_func(cmdline, *, verbose=None, capture_stderr=False, **kw):
+        if isinstance(cmdline, str):
+            cmdline = shlex.split(cmdline)
+        if verbose is None:
+            verbose = os.environ.get("RATIFY_TEST_VERBOSE") == "1"
+        if capture_stderr:
+            kw["stderr"] = subprocess.PIPE
+        argv = [str(binary), *(["-vvv"] if verbose else []), *cmdline]
+        print("*** Running", shlex.join(argv))
+        return subprocess.check_output(argv, **kw)
 
     return run_func
 
 
+def _iter_files(root):
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry.path
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _unlink_then_write(path: pathlib.Path, data: bytes):
+    """Replaces a (possibly hardlinked) file's contents without touching other links"""
+    path.unlink()
+    with path.open("wb") as f:
+        f.write(data)
+
+
 @pytest.fixture
-def directory(tmpdir):
-    tmpdir = pathlib.Path(tmpdir) / "dirname"
-    for filename in ["a/1", "a/2", "b/3", "b/4", "c"]:
-        path = tmpdir / filename
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("wb") as f:
-            f.write(random_data())
-    return tmpdir
+def unlink_then_write():
+    return _unlink_then_write
+
+
+@pytest.fixture(scope="session")
+def _directory_template(tmp_path_factory):
+    template = tmp_path_factory.mktemp("tmpl") / "dirname"
+    filenames = ["a/1", "a/2", "b/3", "b/4", "c"]
+    for parent in sorted({(template / filename).parent for filename in filenames}):
+        parent.mkdir(parents=True)
+    for filename in filenames:
+        (template / filename).write_bytes(random_data())
+    return template
+
+
+@pytest.fixture
+def directory_factory(tmpdir, _directory_template):
+    def factory(parent="."):
+        path = pathlib.Path(tmpdir) / parent / "dirname"
+        # files are hardlinked from the session template -- tests modifying existing
+        # files in place must use unlink_then_write to avoid corrupting the template
+        shutil.copytree(_directory_template, path, copy_function=_link_or_copy)
+        return path
+
+    return factory
+
+
+@pytest.fixture
+def directory(directory_factory):
+    return directory_factory()
 
 
 class Entry:
@@ -58,41 +165,43 @@ class Sigfile:
         self.path = path
 
     def entries(self) -> list[Entry]:
-        with self.path.open() as f:
-            entries = []
-            for line in f:
-                signature, relpath = line.strip().split(" *", 1)
-                entries.append(Entry(self.path, relpath, signature))
-            return entries
+        lines = self.path.read_text().splitlines()
+        return [
+            Entry(self.path, relpath, signature)
+            for signature, relpath in (line.strip().split(" *", 1) for line in lines)
+        ]
 
     def assert_all_files_contained(self, root, *, allow_unknown=False):
         assert not allow_unknown
         entries = self.entries()
 
-        expected_entries = {p for p in root.rglob("*") if not p.is_dir()}
-        expected_entries.remove(self.path)
+        expected_entries = set(_iter_files(root))
+        expected_entries.remove(str(self.path))
 
         assert len(set(entries)) == len(entries), "Duplicates found"
         assert len(entries) == len(expected_entries)
         return entries
 
-    def cfv_verify(self):
-        subprocess.check_call("cfv", cwd=self.path.parent)
+    def cfv_verify(self, cfv):
+        subprocess.check_call([cfv], cwd=self.path.parent)
 
 
 class Algorithm:
-    def name(self):
-        name = type(self).__name__
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
         suffix = "Algorithm"
-        assert name.endswith(suffix)
-        name = name[: -len(suffix)]
-        return name
+        assert cls.__name__.endswith(suffix)
+        cls._name = cls.__name__[: -len(suffix)]
+        cls._name_lower = cls._name.lower()
+
+    def name(self):
+        return self._name
 
     def __str__(self):
-        return self.name().lower()
+        return self._name_lower
 
     def signature_filename(self, directory: pathlib.Path):
-        return f"{directory.name}.{self.name().lower()}"
+        return f"{directory.name}.{self._name_lower}"
 
     def signature_file(self, directory) -> Sigfile:
         path = directory / self.signature_filename(directory)
@@ -128,10 +237,19 @@ def algorithm(request):
     return request.param()
 
 
+@pytest.fixture(scope="session")
+def cfv_available():
+    return shutil.which("cfv")
+
+
 @pytest.fixture
-def cfv_sigfile(directory, algorithm):
+def cfv_sigfile(directory, algorithm, cfv_available):
+    if cfv_available is None:
+        pytest.skip("cfv is not installed")
     sigfile = algorithm.signature_file(directory)
-    subprocess.check_call(f"cfv -C -t {algorithm} -rr .", cwd=directory, shell=True)
+    subprocess.check_call(
+        [cfv_available, "-C", "-t", str(algorithm), "-rr", "."], cwd=directory
+    )
     assert sigfile.path.exists()
     return sigfile
 
@@ -9,7 +9,7 @@ def test_unknown_files_warning(directory, run, algorithm, random_data_gen, repor
     with pytest.raises(subprocess.CalledProcessError) as e:
         run(
             f"test {directory} --report json --report-filename {report.filename}",
-            stderr=subprocess.PIPE,
+            capture_stderr=True,
         )
     assert b"Unknown entries found" in e.value.stderr
     rep = report.load()
@@ -23,8 +23,8 @@ def test_append(directory, run, algorithm, random_data_gen):
     with (directory / "new_file").open("wb") as f:
         f.write(random_data_gen())
     catalog = algorithm.signature_file(directory)
-    with catalog.path.open() as f:
-        assert "new_file" not in f.read()
+    before = catalog.path.read_bytes()
     run(f"append {directory}")
-    with catalog.path.open() as f:
-        assert "new_file" in f.read()
+    after = catalog.path.read_bytes()
+    assert b"new_file" not in before
+    assert b"new_file" in after
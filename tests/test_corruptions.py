@@ -4,13 +4,14 @@ import subprocess
 
 
 @pytest.fixture
-def corruption(directory, cfv_sigfile):
+def corruption(directory, cfv_sigfile, unlink_then_write):
     files = sorted(f for f in directory.rglob("*") if not f.is_dir())
     corrupted = files[1]
     offset = 100_000
-    with corrupted.open("rb+") as f:
-        f.seek(offset)
-        f.write(b"a")
+    data = bytearray(corrupted.read_bytes())
+    data.extend(bytes(max(0, offset - len(data))))
+    data[offset : offset + 1] = b"a"
+    unlink_then_write(corrupted, bytes(data))
     return corrupted
 
 
@@ -18,7 +19,7 @@ def test_cfv_verify(directory, corruption, run, report):
     with pytest.raises(subprocess.CalledProcessError) as e:
         run(
             f"test {directory} --report json --report-filename {report.filename}",
-            stderr=subprocess.PIPE,
+            capture_stderr=True,
         )
     assert b"Failed entries found" in e.value.stderr
 
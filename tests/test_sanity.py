@@ -3,13 +3,22 @@ import pytest
 import subprocess
 
 
-def test_create(directory, run, algorithm):
-    run(f"sign -a {algorithm} .", cwd=directory)
-    sigfile = algorithm.signature_file(directory)
-    assert sigfile.path.exists()
-
-    sigfile.assert_all_files_contained(directory, allow_unknown=False)
-    sigfile.cfv_verify()
+def test_create(directory_factory, run, algos, cfv_available):
+    sigfiles = []
+    for algo in algos:
+        algorithm = algo()
+        directory = directory_factory(str(algorithm))
+        run(f"sign -a {algorithm} .", cwd=directory)
+        sigfile = algorithm.signature_file(directory)
+        assert sigfile.path.exists(), algorithm
+
+        sigfile.assert_all_files_contained(directory, allow_unknown=False)
+        sigfiles.append(sigfile)
+
+    if cfv_available is None:
+        pytest.skip("cfv is not installed")
+    for sigfile in sigfiles:
+        sigfile.cfv_verify(cfv_available)
 
 
 def test_cfv_verify(directory, algorithm, run, cfv_sigfile):